@@ -1,14 +1,31 @@
 import os
+import sys
+import ctypes
+import unicodedata
 import re
+import gzip
+import html
+import hashlib
+import functools
+import queue
 import time
-import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from flask import Flask, request, render_template_string, send_from_directory, abort, jsonify
-from werkzeug.utils import secure_filename
+from flask import Flask, Response, request, send_from_directory, abort, jsonify
+from werkzeug.wsgi import FileWrapper
+from werkzeug.sansio.multipart import MultipartDecoder, NEED_DATA, File, Data, Epilogue
+
+try:  # optional: keeps the file count in sync with changes made outside the app
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
 
 # === Settings ===
 UPLOAD_ROOT = Path("D:/iphone8OLD") / "PhoneUploads"  # your target root
 TMP_DIR = UPLOAD_ROOT / ".incoming"                    # temp chunks here
+THREADS = 16                                           # waitress worker threads
 
 app = Flask(__name__)
 # No MAX_CONTENT_LENGTH -> allow large, streaming uploads
@@ -16,17 +33,117 @@ UPLOAD_ROOT.mkdir(parents=True, exist_ok=True)
 TMP_DIR.mkdir(parents=True, exist_ok=True)
 
 # ---------- helpers ----------
+# Raw fd for .part appends: writes are already >= 1MB, so a BufferedWriter only adds a copy.
+# No mmap: mapping a chunk grows the .part before its data arrives, and its size is the resume offset.
+_APPEND_FLAGS = (os.O_WRONLY | os.O_APPEND | os.O_CREAT
+                 | getattr(os, "O_CLOEXEC", 0) | getattr(os, "O_BINARY", 0))
+CHUNK_BUF_SIZE = 1 << 20  # 1MB server-side read buffer
+_BUF_POOL = queue.LifoQueue(maxsize=THREADS * 2)  # reused receive buffers
+
+def _get_buf() -> bytearray:
+    try:
+        return _BUF_POOL.get_nowait()
+    except queue.Empty:
+        return bytearray(CHUNK_BUF_SIZE)
+
+def _put_buf(buf: bytearray):
+    try:
+        _BUF_POOL.put_nowait(buf)
+    except queue.Full:
+        pass
+
+def _readinto(src, mv: memoryview) -> int:
+    readinto = getattr(src, "readinto", None)
+    if readinto is not None:
+        return readinto(mv) or 0
+    data = src.read(len(mv))  # PEP 3333 only guarantees read()
+    mv[:len(data)] = data
+    return len(data)
+
+def _write_all(fd: int, mv: memoryview):
+    while mv:
+        mv = mv[os.write(fd, mv):]
+
+def _copy_stream(src, fd: int, buf: bytearray, limit: int = None, hasher=None) -> int:
+    """
+    Copy src -> fd through buf via readinto (no per-read allocation); return bytes copied.
+    Stops after limit bytes if given; feeds every block to hasher if given.
+    Short reads (typical on sockets) are coalesced until buf is full, so each
+    write hands the kernel one full buffer.
+    """
+    mv = memoryview(buf)
+    written = 0
+    eof = False
+    while not eof:
+        filled = 0
+        while filled < len(buf):
+            want = len(buf) - filled
+            if limit is not None:
+                want = min(want, limit - written - filled)
+            n = _readinto(src, mv[filled:filled + want]) if want else 0
+            if not n:
+                eof = True
+                break
+            filled += n
+        if filled:
+            if hasher is not None:
+                hasher.update(mv[:filled])
+            _write_all(fd, mv[:filled])
+            written += filled
+    return written
+
+def _body_stream():
+    """
+    Raw WSGI input and the number of body bytes to read from it (None = until EOF).
+    Bypasses Werkzeug's request.stream wrapper.
+    """
+    env = request.environ
+    length = env.get("CONTENT_LENGTH")
+    if length:
+        try:
+            return env["wsgi.input"], max(0, int(length))
+        except ValueError:
+            abort(400, "bad Content-Length")
+    if env.get("wsgi.input_terminated"):
+        return env["wsgi.input"], None
+    return env["wsgi.input"], 0
+
 SAFE_SEG = re.compile(r"^[ .A-Za-z0-9_\-()+=@#,&{}!$%^~\[\]]{1,255}$")
 
+# Built once; str.translate does the per-character work in C, no regex per request.
+_SEG_TBL = str.maketrans({c: "_" for c in map(chr, range(128)) if not SAFE_SEG.match(c)})
+_SEG_OK = bytes(c for c in range(128) if SAFE_SEG.match(chr(c)))
+
+def _is_safe_seg(seg: str) -> bool:
+    """SAFE_SEG's character check as a 256-entry byte lookup: deleting allowed bytes leaves nothing."""
+    return seg.isascii() and not seg.encode("ascii").translate(None, _SEG_OK)
+
+_NAME_KEEP = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_.-")
+_NAME_TBL = str.maketrans({c: None for c in map(chr, range(128)) if c not in _NAME_KEEP})
+_WIN_DEVICES = frozenset(["CON", "PRN", "AUX", "NUL"] + [f"{d}{i}" for d in ("COM", "LPT") for i in range(1, 10)])
+
 def _safe_name(name: str) -> str:
-    s = secure_filename(name)
+    """Same rules as werkzeug's secure_filename, with a translate table instead of its regex."""
+    if not name.isascii():
+        name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode("ascii")
+    for sep in (os.sep, os.path.altsep):
+        if sep:
+            name = name.replace(sep, " ")
+    s = "_".join(name.split()).translate(_NAME_TBL).strip("._")
+    if len(s) > 250:  # leave room for ".part"; cut the stem, keep the extension
+        stem, ext = os.path.splitext(s)
+        if len(ext) > 16:
+            stem, ext = s, ""
+        s = stem[:250 - len(ext)].rstrip("._") + ext
+    if os.name == "nt" and s.partition(".")[0].upper() in _WIN_DEVICES:
+        s = "_" + s
     return s or "upload.bin"
 
 def _safe_relpath(rel: str) -> Path:
     """
     Sanitize a client-provided relative path:
     - split on slashes/backslashes
-    - drop empty, '.', '..', and unsafe segments
+    - drop empty, '.', '..' segments; replace unsafe characters with '_'
     - cap depth to avoid abuse
     """
     parts = []
@@ -34,20 +151,88 @@ def _safe_relpath(rel: str) -> Path:
         seg = raw.strip()
         if not seg or seg in (".", ".."):
             continue
-        if not SAFE_SEG.match(seg):
-            seg = "_"
+        if not _is_safe_seg(seg):  # common case is already clean: skip the rewrite
+            # non-ASCII -> '?' -> '_' via the table
+            seg = seg.encode("ascii", "replace").decode("ascii").translate(_SEG_TBL)
         parts.append(seg[:255])
         if len(parts) >= 50:  # cap depth
             break
     return Path(*parts)
 
-def _tmp_path(name: str, rel: str) -> Path:
+@functools.lru_cache(maxsize=1024)
+def _resolve(name: str, rel: str) -> tuple:
+    """
+    (tmp .part path, final path) for a client (name, relpath). Sanitizing is a
+    pure function of the inputs, so it is cached: a large upload repeats the
+    same pair on every chunk.
+    """
     rp = _safe_relpath(rel)
-    return (TMP_DIR / rp / (_safe_name(name) + ".part"))
+    safe = _safe_name(name)
+    return (TMP_DIR / rp / (safe + ".part"), UPLOAD_ROOT / rp / safe)
 
-def _final_path(name: str, rel: str) -> Path:
-    rp = _safe_relpath(rel)
-    return (UPLOAD_ROOT / rp / _safe_name(name))
+_fallocate = None
+if sys.platform.startswith("linux"):
+    try:
+        _fallocate = ctypes.CDLL(None, use_errno=True).fallocate64
+        _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    except (OSError, AttributeError):
+        _fallocate = None
+
+def _preallocate(fd: int, size: int):
+    """
+    Reserve disk space up to size (contiguous extents, fewer metadata
+    updates) without changing the file size, which the resume protocol
+    relies on. Best effort: silently skipped if unsupported.
+    """
+    try:
+        if os.name == "nt":
+            import msvcrt
+            alloc = ctypes.c_longlong(size)  # FILE_ALLOCATION_INFO
+            ctypes.windll.kernel32.SetFileInformationByHandle(
+                msvcrt.get_osfhandle(fd), 5, ctypes.byref(alloc), ctypes.sizeof(alloc))  # FileAllocationInfo
+        elif _fallocate is not None:
+            _fallocate(fd, 1, 0, size)  # FALLOC_FL_KEEP_SIZE
+    except Exception:
+        pass
+
+# Page-cache hints (Linux): uploads are written once, sequentially, and never read back here.
+_FADV_SEQUENTIAL = getattr(os, "POSIX_FADV_SEQUENTIAL", None)
+_FADV_DONTNEED = getattr(os, "POSIX_FADV_DONTNEED", None)
+
+def _fadvise(fd: int, advice):
+    if advice is None:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, advice)
+    except OSError:
+        pass
+
+def _drop_cache(path: Path):
+    """
+    Let the kernel evict a finished upload's pages instead of more useful ones.
+    DONTNEED skips dirty pages, and right after a large upload most still are,
+    so flush them first. Slow for big files: run it off the request path.
+    """
+    if _FADV_DONTNEED is None:
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fdatasync(fd)
+        _fadvise(fd, _FADV_DONTNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _file_size(p: Path):
+    """Size of p, or None if it does not exist: one stat instead of exists() + stat()."""
+    try:
+        return os.stat(p).st_size
+    except (FileNotFoundError, NotADirectoryError):
+        return None
 
 def _unique_path(p: Path) -> Path:
     if not p.exists():
@@ -60,36 +245,244 @@ def _unique_path(p: Path) -> Path:
             return cand
         i += 1
 
-def _atomic_move_with_retry(src: Path, dst: Path, attempts: int = 10, delay: float = 0.2):
+def _atomic_move_with_retry(src: Path, dst: Path, attempts: int = 10, delay: float = 0.05):
     """
-    Try os.replace repeatedly (handles transient locks on Windows),
-    then fall back to shutil.move (cross-volume safe).
+    Try os.replace repeatedly with exponential backoff (handles transient
+    AV/indexer locks on Windows). src and dst are on the same volume
+    (TMP_DIR lives under UPLOAD_ROOT), so there is no copy fallback.
     """
-    last_err = None
     for i in range(attempts):
         try:
             os.replace(src, dst)  # atomic on same volume
             return
-        except (PermissionError, OSError) as e:
-            last_err = e
-            time.sleep(delay * (i + 1))  # linear backoff
-    try:
-        shutil.move(str(src), str(dst))
-    except Exception as e:
-        raise last_err or e
+        except FileNotFoundError:
+            raise
+        except (PermissionError, OSError):
+            if i == attempts - 1:
+                raise
+            time.sleep(min(2.0, delay * (2 ** i)))  # exponential backoff
 
-def _count_files_excluding_tmp(root: Path, tmp_dir: Path) -> int:
-    """Count all regular files under root, excluding the temp folder and any .part files."""
+def _scandir_count(top: str, skip: str) -> int:
+    """Count regular non-.part files under top (iterative scandir walk), pruning skip."""
     total = 0
-    for dirpath, dirnames, filenames in os.walk(root, topdown=True):
-        # Skip the temp directory
+    stack = [top]
+    while stack:
         try:
-            dirnames.remove(tmp_dir.name)
-        except ValueError:
-            pass
-        total += sum(1 for f in filenames if not f.endswith(".part"))
+            it = os.scandir(stack.pop())
+        except OSError:  # unreadable dir: skip it, like os.walk does
+            continue
+        with it:
+            for entry in it:
+                # DirEntry caches the type from readdir, so no extra stat per entry
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.path != skip:
+                        stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False) and not entry.name.endswith(".part"):
+                    total += 1
     return total
 
+def _count_files_excluding_tmp(root: Path, tmp_dir: Path) -> int:
+    """Count all regular files under root, excluding the temp folder and any .part files.
+
+    Each top-level subdirectory is walked on its own thread so readdir latency
+    (spinning disks, network shares) overlaps.
+    """
+    skip = str(tmp_dir)
+    total = 0
+    subdirs = []
+    with os.scandir(root) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.path != skip:
+                    subdirs.append(entry.path)
+            elif entry.is_file(follow_symlinks=False) and not entry.name.endswith(".part"):
+                total += 1
+    if not subdirs:
+        return total
+    with ThreadPoolExecutor(max_workers=min(8, len(subdirs))) as pool:
+        futs = [pool.submit(_scandir_count, d, skip) for d in subdirs]
+        return total + sum(f.result() for f in as_completed(futs))
+
+# ---------- in-flight chunk writes ----------
+# The offset check and the append are not atomic, so two requests for the same
+# .part (e.g. two different "IMG.jpg" files with the same relpath) must not
+# interleave: the second one is refused instead.
+_writing = set()  # .part paths with a chunk being written
+_writing_lock = threading.Lock()
+
+def _claim_part(tmp: Path) -> bool:
+    with _writing_lock:
+        if tmp in _writing:
+            return False
+        _writing.add(tmp)
+        return True
+
+def _release_part(tmp: Path):
+    with _writing_lock:
+        _writing.discard(tmp)
+
+def _part_busy(tmp: Path) -> bool:
+    with _writing_lock:
+        return tmp in _writing
+
+# ---------- background finalize ----------
+FINALIZE_EXECUTOR = ThreadPoolExecutor(max_workers=4)
+_pending = {}    # tmp .part path -> Future of _finalize
+_finalized = {}  # tmp .part path -> final path of a finished move, until a client asks
+_FINALIZED_MAX = 1024
+_pending_lock = threading.Lock()
+
+def _finalize(tmp: Path, final: Path, size: int) -> str:
+    """Move tmp -> final (runs on FINALIZE_EXECUTOR); return the final path, raise on failure."""
+    try:
+        _atomic_move_with_retry(tmp, final)
+    except FileNotFoundError:
+        if final.exists():
+            return str(final)  # finalized concurrently
+        raise RuntimeError("partial vanished during finalize")
+    except Exception as e:
+        if final.exists():
+            try:
+                if not size or final.stat().st_size == size:
+                    try:
+                        tmp.unlink()
+                    except Exception:
+                        pass
+                    return str(final)  # final existed after error
+            except Exception:
+                pass
+        raise RuntimeError(f"finalize failed: {e}") from e
+
+    if not _watching:
+        _bump_file_count(1)
+    FINALIZE_EXECUTOR.submit(_drop_cache, final)  # don't hold "pending" for the flush
+    return str(final)
+
+def _forget_finalize(tmp: Path, fut):
+    # Failures stay in _pending until a client has seen them. Successes are
+    # remembered by final path, which may be a "name (1).ext" the client
+    # could not find on its own.
+    if fut.exception() is not None:
+        return
+    with _pending_lock:
+        if _pending.get(tmp) is fut:
+            del _pending[tmp]
+            _finalized[tmp] = fut.result()
+            if len(_finalized) > _FINALIZED_MAX:
+                del _finalized[next(iter(_finalized))]
+
+def _finalize_state(tmp: Path):
+    """
+    ("pending", None) while the move for tmp runs. Once it has ended:
+    ("failed", exc) or ("done", final path), each handed out once.
+    (None, None) if nothing is tracked for tmp.
+    """
+    with _pending_lock:
+        fut = _pending.get(tmp)
+        if fut is None:
+            path = _finalized.pop(tmp, None)
+            return ("done", path) if path is not None else (None, None)
+        if not fut.done():
+            return "pending", None
+        del _pending[tmp]  # may beat _forget_finalize; it then leaves things alone
+    exc = fut.exception()
+    return ("failed", exc) if exc is not None else ("done", fut.result())
+
+# ---------- file count ----------
+# Seeded by one walk at startup, then kept up to date by the watcher, so GET /
+# and /stats are O(1). Without watchdog nothing sees changes made on the PC, so
+# /stats walks again (at most every _COUNT_MAX_AGE seconds).
+# Directory deletes/moves carry no per-file events, so those trigger a fresh
+# walk once the burst of events has gone quiet.
+_file_count = 0
+_file_count_lock = threading.Lock()
+_counted_at = 0.0
+_COUNT_MAX_AGE = 2.0
+_watching = False
+
+def _bump_file_count(delta: int):
+    global _file_count
+    with _file_count_lock:
+        _file_count = max(0, _file_count + delta)
+
+def _get_file_count() -> int:
+    if not _watching and time.monotonic() - _counted_at >= _COUNT_MAX_AGE:
+        _reseed_file_count()
+    with _file_count_lock:
+        return _file_count
+
+def _reseed_file_count():
+    global _file_count, _counted_at
+    total = _count_files_excluding_tmp(UPLOAD_ROOT, TMP_DIR)
+    with _file_count_lock:
+        _file_count = total
+        _counted_at = time.monotonic()
+
+_RESEED_QUIET = 1.0      # seconds without directory events before recounting
+_RESEED_MAX_WAIT = 10.0  # recount anyway if events keep coming this long
+_reseed_timer = None
+_reseed_since = 0.0
+_reseed_lock = threading.Lock()
+
+def _schedule_reseed():
+    """Recount once per burst: an rmtree of 100 folders sends 101 directory events."""
+    global _reseed_timer, _reseed_since
+    now = time.monotonic()
+    with _reseed_lock:
+        if _reseed_timer is None:
+            _reseed_since = now
+        elif now - _reseed_since < _RESEED_MAX_WAIT:
+            _reseed_timer.cancel()
+        else:
+            return  # waited long enough; let the pending recount run
+        _reseed_timer = threading.Timer(_RESEED_QUIET, _run_reseed)
+        _reseed_timer.daemon = True
+        _reseed_timer.start()
+
+def _run_reseed():
+    global _reseed_timer
+    with _reseed_lock:
+        if _reseed_timer is threading.current_thread():
+            _reseed_timer = None
+    _reseed_file_count()
+
+def _is_counted(path: str) -> bool:
+    """True for paths that _count_files_excluding_tmp would count."""
+    p = Path(path)
+    return not p.name.endswith(".part") and TMP_DIR not in p.parents
+
+if Observer is not None:
+    class _CountHandler(FileSystemEventHandler):
+        def on_created(self, event):
+            if not event.is_directory and _is_counted(event.src_path):
+                _bump_file_count(1)
+
+        def on_deleted(self, event):
+            if event.is_directory:
+                _schedule_reseed()
+            elif _is_counted(event.src_path):
+                _bump_file_count(-1)
+
+        def on_moved(self, event):
+            # a folder moved out (e.g. to the Recycle Bin) reports only itself
+            if event.is_directory:
+                _schedule_reseed()
+            else:  # .part -> final rename in /upload/finish lands here
+                _bump_file_count(_is_counted(event.dest_path) - _is_counted(event.src_path))
+
+def _start_file_count():
+    global _watching
+    _reseed_file_count()
+    if Observer is None:
+        return
+    observer = Observer()
+    observer.schedule(_CountHandler(), str(UPLOAD_ROOT), recursive=True)
+    observer.daemon = True
+    observer.start()
+    _watching = True
+
+_start_file_count()
+
 # ---------- UI ----------
 PAGE = """
 <!doctype html>
@@ -150,7 +543,7 @@ PAGE = """
       <div id="jobs"></div>
 
       <div class="stats">
-        <b>Destination file count:</b> <span id="destCount">{{ file_count }}</span>
+        <b>Destination file count:</b> <span id="destCount">…</span>
         <button type="button" id="refreshStats" class="ghost" style="margin-left:8px">Refresh</button>
       </div>
 
@@ -316,33 +709,70 @@ async function getReceived(name, size, relpath) {
   return j.received || 0;
 }
 
+// /upload/finish answers 202 while the rename runs server-side; poll until it settles
+async function waitFinalized(name, size, relpath) {
+  for (;;) {
+    await new Promise(res => setTimeout(res, 250));
+    const r = await fetch(`/upload/status?name=${encodeURIComponent(name)}&size=${size}&relpath=${encodeURIComponent(relpath||'')}`);
+    if (!r.ok) throw new Error('status failed');
+    const j = await r.json();
+    if (j.error) throw new Error(j.error);
+    if (j.complete) return;
+    if (!j.pending) throw new Error('finalize did not complete');
+  }
+}
+
+// per-chunk SHA-256 (SubtleCrypto is only exposed on https:// or localhost pages)
+const HAS_SUBTLE = typeof crypto !== 'undefined' && !!crypto.subtle;
+const toHex = (buf) => Array.from(new Uint8Array(buf), b => b.toString(16).padStart(2, '0')).join('');
+
 async function uploadItem(item) {
   const file = item.file;
   const relpath = item.relpath || '';
   const ui = addRow(file.name, relpath);
   const size = file.size || 0;
-  let offset = await getReceived(file.name, size, relpath);
   const chunkSize = 16 * 1024 * 1024; // 16MB
+  // read (and hash) the next chunk while the current one is on the wire
+  const readChunk = async (start) => {
+    const body = await file.slice(start, Math.min(start + chunkSize, size)).arrayBuffer();
+    const sum = HAS_SUBTLE ? toHex(await crypto.subtle.digest('SHA-256', body)) : null;
+    return {body, sum};
+  };
+  let retries = 0;
 
   try {
+    let offset = await getReceived(file.name, size, relpath);
+    let next = offset < size ? readChunk(offset) : null;
     while (offset < size) {
-      const chunk = file.slice(offset, Math.min(offset + chunkSize, size));
+      const {body, sum} = await next;
+      const end = offset + body.byteLength;
+      next = end < size ? readChunk(end) : null;
       const res = await fetch(`/upload/chunk?name=${encodeURIComponent(file.name)}&size=${size}&offset=${offset}&relpath=${encodeURIComponent(relpath)}`, {
         method: 'POST',
-        body: chunk,
+        headers: sum ? {'X-Chunk-SHA256': sum} : {},
+        body,
       });
       if (res.status === 409) {
         const j = await res.json();
         offset = j.received || 0;
+        next = offset < size ? readChunk(offset) : null;
+        continue;
+      }
+      if (res.status === 422 && retries++ < 3) { // corrupted in transit: server dropped it, resend
+        next = readChunk(offset);
         continue;
       }
       if (!res.ok) throw new Error(await res.text());
+      retries = 0;
       const j = await res.json();
-      offset = j.received || (offset + chunk.size);
+      const received = j.received || end;
+      if (received !== end && received < size) next = readChunk(received);
+      offset = received;
       ui.setProgress((offset / size) * 100);
     }
     const fin = await fetch(`/upload/finish?name=${encodeURIComponent(file.name)}&size=${size}&relpath=${encodeURIComponent(relpath)}`, { method: 'POST' });
     if (!fin.ok) throw new Error(await fin.text());
+    if (fin.status === 202) await waitFinalized(file.name, size, relpath);
     ui.ok('done');
   } catch (e) {
     console.error(e);
@@ -350,22 +780,49 @@ async function uploadItem(item) {
   }
 }
 
+// a few files in flight at once; iOS stays sequential (more reliable there)
+// iPadOS 13+ sends a desktop Mac user agent; touch points give it away
+const IS_IOS = /iPad|iPhone|iPod/.test(navigator.userAgent)
+  || (navigator.platform === 'MacIntel' && navigator.maxTouchPoints > 1);
+const CONCURRENCY = IS_IOS ? 1 : 3;
+
+async function runPool(items, n){
+  // Items with the same name + relpath share one .part on the server, so they
+  // go in one group and upload one after another, never side by side.
+  const groups = new Map();
+  for (const item of items) {
+    const key = item.file.name + '\\0' + (item.relpath || '');
+    if (!groups.has(key)) groups.set(key, []);
+    groups.get(key).push(item);
+  }
+  const it = groups.values();  // shared, so each group is taken once
+  await Promise.all(Array.from({length: n}, async () => {
+    for (const group of it) {
+      for (const item of group) await uploadItem(item);
+    }
+  }));
+}
+
 startBtn.addEventListener('click', async ()=>{
   if (!queue.length) return;
-  for (const it of queue) { await uploadItem(it); } // sequential = more reliable esp. on iOS
+  await runPool(queue.slice(), CONCURRENCY);
   queue.length = 0;
   renderQueue();
   // Reload so the file count updates
   window.location.reload();
 });
 
-// Manual refresh for file count
+// File count (the page itself is static, so it is fetched on load and on Refresh)
+async function refreshStats(){
+  const r = await fetch('/stats', {cache: 'no-cache'});  // revalidate (cheap 304)
+  if (!r.ok) throw new Error('stats failed');
+  const j = await r.json();
+  destCountEl.textContent = j.files;
+}
+refreshStats().catch(e => console.error(e));
 refreshBtn.addEventListener('click', async ()=>{
   try{
-    const r = await fetch('/stats');
-    if (!r.ok) throw new Error('stats failed');
-    const j = await r.json();
-    destCountEl.textContent = j.files;
+    await refreshStats();
   }catch(e){
     alert('Could not refresh stats');
   }
@@ -375,37 +832,86 @@ refreshBtn.addEventListener('click', async ()=>{
 </html>
 """
 
+# The page has no per-request content, so render and gzip it once.
+PAGE_HTML = PAGE.replace("{{ upload_dir }}", html.escape(str(UPLOAD_ROOT))).encode("utf-8")
+PAGE_GZIP = gzip.compress(PAGE_HTML, compresslevel=9)
+PAGE_ETAG = hashlib.sha256(PAGE_HTML).hexdigest()[:16]
+
+def _cached(resp: Response, etag: str, weak: bool = False) -> Response:
+    """Tag resp, allow short private caching, and turn it into a 304 if the client has it."""
+    resp.set_etag(etag, weak=weak)
+    resp.cache_control.private = True
+    resp.cache_control.max_age = 5
+    return resp.make_conditional(request)
+
 # ---------- routes ----------
 @app.route("/", methods=["GET"])
 def index():
-    file_count = _count_files_excluding_tmp(UPLOAD_ROOT, TMP_DIR)
-    return render_template_string(PAGE, file_count=file_count, upload_dir=str(UPLOAD_ROOT))
+    if request.accept_encodings["gzip"]:
+        resp = Response(PAGE_GZIP, mimetype="text/html")
+        resp.headers["Content-Encoding"] = "gzip"
+        etag = PAGE_ETAG + "-gz"  # strong ETags differ per encoding
+    else:
+        resp = Response(PAGE_HTML, mimetype="text/html")
+        etag = PAGE_ETAG
+    resp.vary.add("Accept-Encoding")
+    return _cached(resp, etag)
 
 # Simple stats endpoint (used by the "Refresh" button)
 @app.get("/stats")
 def stats():
-    return jsonify({"files": _count_files_excluding_tmp(UPLOAD_ROOT, TMP_DIR)})
+    count = _get_file_count()
+    return _cached(jsonify({"files": count}), str(count), weak=True)
 
 # Legacy endpoint kept (small uploads via <form>, still streams in chunks)
 @app.post("/upload")
 def upload_legacy():
-    if "files" not in request.files:
+    # Stream the multipart body through Werkzeug's sans-IO decoder instead of
+    # request.files, writing each file part straight to disk.
+    boundary = request.mimetype_params.get("boundary")
+    if request.mimetype != "multipart/form-data" or not boundary:
         abort(400, "No files part")
-    files = request.files.getlist("files")
+    src, limit = _body_stream()
+    decoder = MultipartDecoder(boundary.encode("latin-1"))
+    found = False
     saved = 0
-    for f in files:
-        if not f or not f.filename.strip():
-            continue
-        name = _safe_name(f.filename)
-        dst = _unique_path(_final_path(name, rel=""))
-        dst.parent.mkdir(parents=True, exist_ok=True)
-        with open(dst, "wb") as out:
-            while True:
-                chunk = f.stream.read(8 * 1024 * 1024)
-                if not chunk:
-                    break
-                out.write(chunk)
-        saved += 1
+    read = 0
+    dst = out = None
+    buf = _get_buf()
+    mv = memoryview(buf)
+    try:
+        while True:
+            event = decoder.next_event()
+            if event is NEED_DATA:
+                want = len(buf) if limit is None else min(len(buf), limit - read)
+                n = _readinto(src, mv[:want]) if want else 0
+                read += n
+                decoder.receive_data(mv[:n] if n else None)
+            elif isinstance(event, File) and event.name == "files":
+                found = True
+                if event.filename.strip():
+                    dst = _unique_path(_resolve(event.filename, "")[1])
+                    dst.parent.mkdir(parents=True, exist_ok=True)
+                    out = open(dst, "wb")
+            elif isinstance(event, Data) and out is not None:
+                out.write(event.data)
+                if not event.more_data:
+                    out.close()
+                    out = None
+                    saved += 1
+            elif isinstance(event, Epilogue):
+                break
+    except ValueError:
+        abort(400, "malformed multipart body")
+    finally:
+        if out is not None:  # interrupted mid-file: drop the partial
+            out.close()
+            dst.unlink(missing_ok=True)
+        _put_buf(buf)
+    if not found:
+        abort(400, "No files part")
+    if not _watching:
+        _bump_file_count(saved)
     return (f"Uploaded {saved} file(s). <a href='/'>Back</a>", 200)
 
 # Resumable: query how many bytes already received for (name, relpath)
@@ -417,16 +923,27 @@ def upload_status():
     if not name or size < 0:
         abort(400, "name/size required")
 
-    tmp = _tmp_path(name, relpath)
-    if tmp.exists():
-        return jsonify({"received": tmp.stat().st_size})
+    tmp, final = _resolve(name, relpath)
+    state, result = _finalize_state(tmp)
+    if state == "pending":
+        return jsonify({"received": size, "pending": True})
+    if state == "failed":
+        return jsonify({"received": _file_size(tmp) or 0, "error": str(result)})
 
-    final = _final_path(name, relpath)
-    if final.exists():
-        if not size or final.stat().st_size == size:
-            return jsonify({"received": size or final.stat().st_size, "complete": True})
-        return jsonify({"received": final.stat().st_size})
+    received = _file_size(tmp)
+    if received is not None:
+        return jsonify({"received": received})
 
+    if state == "done":
+        done_size = _file_size(Path(result))
+        if done_size is not None and (not size or done_size == size):
+            return jsonify({"received": done_size, "complete": True, "path": result})
+
+    final_size = _file_size(final)
+    if final_size is not None and (not size or final_size == size):
+        return jsonify({"received": final_size, "complete": True})
+
+    # a final file of another size is a different file: start over in a new .part
     return jsonify({"received": 0})
 
 # Resumable: append chunk at given offset
@@ -439,27 +956,51 @@ def upload_chunk():
     if not name or size < 0 or offset < 0:
         abort(400, "name/size/offset required")
 
-    tmp = _tmp_path(name, relpath)
-    current = tmp.stat().st_size if tmp.exists() else 0
+    tmp, _ = _resolve(name, relpath)
+    if not _claim_part(tmp):
+        abort(423, "another upload is writing this file")
+    try:
+        return _write_chunk(tmp, size, offset)
+    finally:
+        _release_part(tmp)
+
+def _write_chunk(tmp: Path, size: int, offset: int):
+    """Body of upload_chunk, run while holding the claim on tmp."""
+    current = _file_size(tmp) or 0
     if offset != current:
         return jsonify({"received": current}), 409
 
     tmp.parent.mkdir(parents=True, exist_ok=True)
-    written = 0
-    with open(tmp, "ab") as out:
-        while True:
-            chunk = request.stream.read(8 * 1024 * 1024)  # 8MB server-side read
-            if not chunk:
-                break
-            out.write(chunk)
-            written += len(chunk)
+    src, limit = _body_stream()
+    # optional integrity check; hashlib's OpenSSL SHA-256 keeps pace with the disk
+    expected = request.headers.get("X-Chunk-SHA256", "").strip().lower()
+    hasher = hashlib.sha256() if expected else None
+    fd = os.open(tmp, _APPEND_FLAGS, 0o644)
+    buf = _get_buf()
+    try:
+        _fadvise(fd, _FADV_SEQUENTIAL)
+        if limit and size > current:
+            # Only this chunk's range: the reservation does not show in the file
+            # size, so an abandoned .part must not hold the rest of the upload,
+            # and a declared size alone cannot claim the disk. Redone per chunk
+            # anyway, since NTFS releases allocation beyond EOF on close.
+            _preallocate(fd, min(size, current + limit))
+        written = _copy_stream(src, fd, buf, limit, hasher)
+        if hasher is not None and hasher.hexdigest() != expected:
+            os.ftruncate(fd, current)  # drop the bad chunk so the client can resend it
+            return jsonify({"received": current, "error": "chunk checksum mismatch"}), 422
+    finally:
+        os.close(fd)
+        _put_buf(buf)
 
     received = current + written
     if received > size > 0:
         abort(400, "received more bytes than declared size")
     return jsonify({"received": received})
 
-# Resumable: finalize upload (rename .part -> final) — idempotent & robust
+# Resumable: finalize upload (rename .part -> final) — idempotent & robust.
+# The rename can stall for seconds on Windows AV/indexer locks, so it runs in
+# the background: the request returns 202 and /upload/status reports the outcome.
 @app.post("/upload/finish")
 def upload_finish():
     name = request.args.get("name", "")
@@ -468,8 +1009,18 @@ def upload_finish():
     if not name:
         abort(400, "name required")
 
-    tmp = _tmp_path(name, relpath)
-    final_pref = _final_path(name, relpath)
+    tmp, final_pref = _resolve(name, relpath)
+
+    if _part_busy(tmp):
+        abort(423, "a chunk for this file is still being written")
+
+    state, result = _finalize_state(tmp)
+    if state == "pending":
+        return jsonify({"ok": True, "pending": True}), 202
+    if state == "failed":
+        abort(500, str(result))
+    if state == "done" and not tmp.exists():
+        return jsonify({"ok": True, "path": result, "note": "already finalized"})
 
     if final_pref.exists():
         if not tmp.exists():
@@ -485,33 +1036,38 @@ def upload_finish():
 
     final_pref.parent.mkdir(parents=True, exist_ok=True)
 
-    try:
-        _atomic_move_with_retry(tmp, final_pref)
-    except FileNotFoundError:
-        if final_pref.exists():
-            return jsonify({"ok": True, "path": str(final_pref), "note": "finalized concurrently"})
-        abort(404, "partial vanished during finalize")
-    except Exception as e:
-        if final_pref.exists():
-            try:
-                if not size or final_pref.stat().st_size == size:
-                    try:
-                        tmp.unlink()
-                    except Exception:
-                        pass
-                    return jsonify({"ok": True, "path": str(final_pref), "note": "final existed after error"})
-            except Exception:
-                pass
-        abort(500, f"finalize failed: {e}")
-
-    return jsonify({"ok": True, "path": str(final_pref)})
+    with _pending_lock:
+        fut = None
+        if tmp not in _pending:
+            fut = _pending[tmp] = FINALIZE_EXECUTOR.submit(_finalize, tmp, final_pref, size)
+    if fut is not None:
+        # outside the lock: the callback runs right here if the move already finished
+        fut.add_done_callback(lambda f, key=tmp: _forget_finalize(key, f))
+    return jsonify({"ok": True, "pending": True, "path": str(final_pref)}), 202
 
 @app.route("/downloads/<path:filename>")
 def downloads(filename):
-    return send_from_directory(UPLOAD_ROOT, filename, as_attachment=False)
+    resp = send_from_directory(UPLOAD_ROOT, filename, as_attachment=False)
+    # waitress supplies wsgi.file_wrapper and reads the open file in SO_SNDBUF
+    # sized blocks. Werkzeug's fallback wrapper (dev server) reads 8KB per
+    # iteration; give it 1MB blocks instead.
+    if isinstance(resp.response, FileWrapper):
+        resp.response.buffer_size = 1 << 20
+    return resp
 
 if __name__ == "__main__":
-    # For marathon sessions you can use waitress:
-    #   pip install waitress
-    #   python -m waitress --listen=0.0.0.0:5000 Server:app
-    app.run(host="0.0.0.0", port=5000, debug=False)
+    try:
+        from waitress import serve
+    except ImportError:  # pip install waitress (the dev server serializes uploads)
+        app.run(host="0.0.0.0", port=5000, debug=False, threaded=True)
+    else:
+        serve(app, host="0.0.0.0", port=5000, threads=THREADS,
+              recv_bytes=1 << 20,  # read request bodies 1MB per recv() (default 8KB)
+              # waitress reads the whole body before calling the app and spools
+              # anything over inbuf_overflow (default 512KB) to a temp file. Keep
+              # a 16MB client chunk in RAM (up to 17MB per open upload) so it is
+              # written to disk once, into the .part.
+              inbuf_overflow=17 << 20,
+              # default caps bodies at 1GB; legacy /upload posts may be larger
+              max_request_body_size=sys.maxsize,
+              channel_timeout=3600)